@@ -1,5 +1,9 @@
+import concurrent.futures
+import dataclasses
+import functools
 import logging
-import os
+import operator
+import shutil
 import sys
 import threading
 
@@ -19,6 +23,34 @@ try:
 except ImportError:
     coloredlogs = None
 
+# The maximum number of updates Telegram allows to be fetched with a single request
+UPDATES_LIMIT = 100
+# The number of threads sending the replies of the core loop
+REPLY_SENDER_THREADS = 8
+
+
+@dataclasses.dataclass(frozen=True)
+class CoreConfig:
+    """The user config values read by the core, resolved once at startup."""
+    # Declared by hand, as dataclass(slots=True) needs Python 3.10
+    __slots__ = ("log_level", "log_format", "database_engine", "default_language", "long_polling_timeout",
+                 "max_conversations")
+    log_level: str
+    log_format: str
+    database_engine: str
+    default_language: str
+    long_polling_timeout: int
+    max_conversations: int
+
+    @classmethod
+    def from_nuconfig(cls, cfg: nuconfig.NuConfig) -> "CoreConfig":
+        return cls(log_level=cfg["Logging"]["level"],
+                   log_format=cfg["Logging"]["format"],
+                   database_engine=cfg["Database"]["engine"],
+                   default_language=cfg["Language"]["default_language"],
+                   long_polling_timeout=cfg["Telegram"]["long_polling_timeout"],
+                   max_conversations=cfg["Telegram"]["max_conversations"])
+
 
 def main():
     
@@ -31,41 +63,42 @@ def main():
     log.debug("Set logging level to INFO while the config is being loaded")
 
     
-    if not os.path.isfile("config/template_config.toml"):
+    try:
+        template_cfg_file = open("config/template_config.toml", "rb")
+    except FileNotFoundError:
         log.fatal("config/template_config.toml does not exist!")
-        exit(254)
+        sys.exit(254)
 
     
-    if not os.path.isfile("config/config.toml"):
+    try:
+        user_cfg_file = open("config/config.toml", "rb")
+    except FileNotFoundError:
         log.debug("config/config.toml does not exist.")
-
-        with open("config/template_config.toml", encoding="utf8") as template_cfg_file, \
-                open("config/config.toml", "w", encoding="utf8") as user_cfg_file:
-            
-            user_cfg_file.write(template_cfg_file.read())
-
+        template_cfg_file.close()
+        
+        shutil.copyfile("config/template_config.toml", "config/config.toml")
         log.fatal("A config file has been created in config/config.toml."
                   " Customize it, then restart greed!")
-        exit(1)
+        sys.exit(1)
 
     
-    with open("config/template_config.toml", encoding="utf8") as template_cfg_file, \
-            open("config/config.toml", encoding="utf8") as user_cfg_file:
+    with template_cfg_file, user_cfg_file:
         template_cfg = nuconfig.NuConfig(template_cfg_file)
         user_cfg = nuconfig.NuConfig(user_cfg_file)
         if not template_cfg.cmplog(user_cfg):
             log.fatal("There were errors while parsing the config.toml file. Please fix them and restart greed!")
-            exit(2)
+            sys.exit(2)
         else:
             log.debug("Configuration parsed successfully!")
+    core_cfg = CoreConfig.from_nuconfig(user_cfg)
 
     
-    logging.root.setLevel(user_cfg["Logging"]["level"])
+    logging.root.setLevel(core_cfg.log_level)
     stream_handler = logging.StreamHandler()
     if coloredlogs is not None:
-        stream_handler.formatter = coloredlogs.ColoredFormatter(user_cfg["Logging"]["format"], style="{")
+        stream_handler.formatter = coloredlogs.ColoredFormatter(core_cfg.log_format, style="{")
     else:
-        stream_handler.formatter = logging.Formatter(user_cfg["Logging"]["format"], style="{")
+        stream_handler.formatter = logging.Formatter(core_cfg.log_format, style="{")
     logging.root.handlers.clear()
     logging.root.addHandler(stream_handler)
     log.debug("Logging setup successfully!")
@@ -75,16 +108,23 @@ def main():
 
     
     log.debug("Creating the sqlalchemy engine...")
-    engine = sqlalchemy.create_engine(user_cfg["Database"]["engine"])
-    log.debug("Binding metadata to the engine...")
-    database.TableDeclarativeBase.metadata.bind = engine
+    engine_url = sqlalchemy.engine.url.make_url(core_cfg.database_engine)
+    engine_options = {"pool_pre_ping": True}
+    if engine_url.get_backend_name() != "sqlite":
+        # Each running conversation keeps a connection checked out while it waits for the user
+        engine_options["pool_size"] = core_cfg.max_conversations
+    engine = sqlalchemy.create_engine(engine_url, future=True, **engine_options)
     log.debug("Creating all missing tables...")
-    database.TableDeclarativeBase.metadata.create_all()
+    database.TableDeclarativeBase.metadata.create_all(bind=engine)
     log.debug("Preparing the tables through deferred reflection...")
     sed.DeferredReflection.prepare(engine)
+    session_factory = sqlalchemy.orm.scoped_session(sqlalchemy.orm.sessionmaker(bind=engine))
 
     
-    bot = duckbot.factory(user_cfg)()
+    # One connection for each thread sharing the bot: the conversations, the core loop, its reply senders
+    # and the IO and upload pools of the workers
+    bot = duckbot.factory(user_cfg)(con_pool_size=core_cfg.max_conversations + 1 + REPLY_SENDER_THREADS
+                                                  + worker.IO_THREADS + worker.UPLOAD_THREADS)
 
     
     log.debug("Testing bot token...")
@@ -95,13 +135,24 @@ def main():
     log.debug("Bot token is valid!")
 
     
-    default_language = user_cfg["Language"]["default_language"]
+    default_loc = localization.Localization(language=core_cfg.default_language,
+                                            fallback=core_cfg.default_language)
     
-    default_loc = localization.Localization(language=default_language, fallback=default_language)
+    error_nonprivate_chat = default_loc.get("error_nonprivate_chat")
+    error_no_worker_for_chat = default_loc.get("error_no_worker_for_chat")
+    error_worker_not_ready = default_loc.get("error_worker_not_ready")
+    error_invoice_expired = default_loc.get("error_invoice_expired")
 
     
     
+    # Workers are removed once their conversation ends, so that updates aren't queued for a finished worker
     chat_workers = {}
+    chat_workers_lock = threading.Lock()
+    
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=core_cfg.max_conversations,
+                                                     thread_name_prefix="Worker")
+    
+    sender = concurrent.futures.ThreadPoolExecutor(max_workers=REPLY_SENDER_THREADS, thread_name_prefix="Sender")
 
     
     next_update = None
@@ -110,121 +161,172 @@ def main():
     log.info(f"@{me.username} is starting!")
 
     
-    while True:
+    get_worker = chat_workers.get
+    send_message = bot.send_message
+    CancelSignal = worker.CancelSignal
+
+    def log_failed_reply(future: concurrent.futures.Future):
+        if future.exception() is not None:
+            log.error(f"Failed to send a reply: {future.exception()}")
+
+    def reply(*args, **kwargs):
+        sender.submit(send_message, *args, **kwargs).add_done_callback(log_failed_reply)
+
+    def forget_worker(finished_worker: worker.Worker, _future: concurrent.futures.Future):
+        # Runs on the worker's thread; the chat may already have been handed to a newer worker by /start
+        with chat_workers_lock:
+            if chat_workers.get(finished_worker.chat.id) is finished_worker:
+                del chat_workers[finished_worker.chat.id]
+
+    
+    def handle_message(update: telegram.Update, message: telegram.Message):
         
-        update_timeout = user_cfg["Telegram"]["long_polling_timeout"]
-        log.debug(f"Getting updates from Telegram with a timeout of {update_timeout} seconds")
-        updates = bot.get_updates(offset=next_update,
-                                  timeout=update_timeout)
+        if message.chat.type != "private":
+            log.debug("Received a message from a non-private chat: %s", message.chat.id)
+            
+            reply(message.chat.id, error_nonprivate_chat)
+            return
         
-        for update in updates:
+        if message.text is not None and message.text.startswith("/start"):
+            log.info(f"Received /start from: {message.chat.id}")
             
-            if update.message is not None:
-                
-                if update.message.chat.type != "private":
-                    log.debug(f"Received a message from a non-private chat: {update.message.chat.id}")
-                    
-                    bot.send_message(update.message.chat.id, default_loc.get("error_nonprivate_chat"))
-                    
-                    continue
-                
-                if isinstance(update.message.text, str) and update.message.text.startswith("/start"):
-                    log.info(f"Received /start from: {update.message.chat.id}")
-                    
-                    old_worker = chat_workers.get(update.message.chat.id)
-                    
-                    if old_worker:
-                        log.debug(f"Received request to stop {old_worker.name}")
-                        old_worker.stop("request")
-                    
-                    new_worker = worker.Worker(bot=bot,
-                                               chat=update.message.chat,
-                                               telegram_user=update.message.from_user,
-                                               cfg=user_cfg,
-                                               engine=engine,
-                                               daemon=True)
-                    
-                    log.debug(f"Starting {new_worker.name}")
-                    new_worker.start()
-                    
-                    chat_workers[update.message.chat.id] = new_worker
-                    
-                    continue
-                
-                receiving_worker = chat_workers.get(update.message.chat.id)
-                
-                if receiving_worker is None:
-                    log.debug(f"Received a message in a chat without worker: {update.message.chat.id}")
-                    
-                    bot.send_message(update.message.chat.id, default_loc.get("error_no_worker_for_chat"),
-                                     reply_markup=telegram.ReplyKeyboardRemove())
-                    
-                    continue
-                
-                if not receiving_worker.is_ready():
-                    log.debug(f"Received a message in a chat where the worker wasn't ready yet: {update.message.chat.id}")
-                    
-                    bot.send_message(update.message.chat.id, default_loc.get("error_worker_not_ready"),
-                                     reply_markup=telegram.ReplyKeyboardRemove())
-                    
-                    continue
-                
-                if update.message.text == receiving_worker.loc.get("menu_cancel"):
-                    log.debug(f"Forwarding CancelSignal to {receiving_worker}")
-                    
-                    receiving_worker.queue.put(worker.CancelSignal())
-                else:
-                    log.debug(f"Forwarding message to {receiving_worker}")
-                    
-                    receiving_worker.queue.put(update)
-            
-            if isinstance(update.callback_query, telegram.CallbackQuery):
-                
-                receiving_worker = chat_workers.get(update.callback_query.from_user.id)
-                
-                if receiving_worker is None:
-                    log.debug(
-                        f"Received a callback query in a chat without worker: {update.callback_query.from_user.id}")
-                    
-                    bot.send_message(update.callback_query.from_user.id, default_loc.get("error_no_worker_for_chat"))
-                    
-                    continue
-                
-                if update.callback_query.data == "cmd_cancel":
-                    log.debug(f"Forwarding CancelSignal to {receiving_worker}")
-                    
-                    receiving_worker.queue.put(worker.CancelSignal())
-                    
-                    bot.answer_callback_query(update.callback_query.id)
-                else:
-                    log.debug(f"Forwarding callback query to {receiving_worker}")
-                    
-                    receiving_worker.queue.put(update)
-            
-            if isinstance(update.pre_checkout_query, telegram.PreCheckoutQuery):
-                
-                receiving_worker = chat_workers.get(update.pre_checkout_query.from_user.id)
-                
-                if receiving_worker is None or \
-                        update.pre_checkout_query.invoice_payload != receiving_worker.invoice_payload:
-                    
-                    log.debug(f"Received a pre-checkout query for an expired invoice in: {update.pre_checkout_query.from_user.id}")
-                    try:
-                        bot.answer_pre_checkout_query(update.pre_checkout_query.id,
-                                                      ok=False,
-                                                      error_message=default_loc.get("error_invoice_expired"))
-                    except telegram.error.BadRequest:
-                        log.error("pre-checkout query expired before an answer could be sent!")
-                    
-                    continue
-                log.debug(f"Forwarding pre-checkout query to {receiving_worker}")
-                
-                receiving_worker.queue.put(update)
+            old_worker = get_worker(message.chat.id)
+            
+            if old_worker:
+                log.debug("Received request to stop %s", old_worker.name)
+                old_worker.stop("request")
+            
+            new_worker = worker.Worker(bot=bot,
+                                       chat=message.chat,
+                                       telegram_user=message.from_user,
+                                       cfg=user_cfg,
+                                       session_factory=session_factory)
+            
+            idle_worker = None
+            with chat_workers_lock:
+                chat_workers[message.chat.id] = new_worker
+                # Conversations hold a thread until they end, which without messages takes conversation_timeout,
+                # so instead of queueing the new one behind them, end the one that has been idle the longest
+                if len(chat_workers) > core_cfg.max_conversations:
+                    idle_worker = min((running_worker for running_worker in chat_workers.values()
+                                       if running_worker is not new_worker),
+                                      key=operator.attrgetter("last_update"))
+                    del chat_workers[idle_worker.chat.id]
+            
+            if idle_worker is not None:
+                log.warning(f"Reached the limit of {core_cfg.max_conversations} conversations,"
+                            f" stopping the least recently active one: {idle_worker.name}")
+                idle_worker.stop("timeout")
+            
+            log.debug("Starting %s", new_worker.name)
+            new_worker.start(executor)
+            new_worker.future.add_done_callback(functools.partial(forget_worker, new_worker))
+            return
+        
+        receiving_worker = get_worker(message.chat.id)
+        
+        if receiving_worker is None:
+            log.debug("Received a message in a chat without worker: %s", message.chat.id)
+            
+            reply(message.chat.id, error_no_worker_for_chat, reply_markup=worker.REMOVE_KEYBOARD)
+            return
+        
+        if not receiving_worker.is_ready():
+            log.debug("Received a message in a chat where the worker wasn't ready yet: %s", message.chat.id)
+            
+            reply(message.chat.id, error_worker_not_ready, reply_markup=worker.REMOVE_KEYBOARD)
+            return
+        
+        if message.text == receiving_worker.cancel_text:
+            log.debug("Forwarding CancelSignal to %s", receiving_worker)
+            
+            receiving_worker.queue.put(CancelSignal())
+        else:
+            log.debug("Forwarding message to %s", receiving_worker)
+            
+            receiving_worker.queue.put(update)
+
+    def handle_callback_query(update: telegram.Update, callback_query: telegram.CallbackQuery):
+        
+        receiving_worker = get_worker(callback_query.from_user.id)
+        
+        if receiving_worker is None:
+            log.debug("Received a callback query in a chat without worker: %s", callback_query.from_user.id)
+            
+            reply(callback_query.from_user.id, error_no_worker_for_chat)
+            return
+        
+        if callback_query.data == "cmd_cancel":
+            log.debug("Forwarding CancelSignal to %s", receiving_worker)
+            
+            receiving_worker.queue.put(CancelSignal())
+            
+            bot.answer_callback_query(callback_query.id)
+        else:
+            log.debug("Forwarding callback query to %s", receiving_worker)
+            
+            receiving_worker.queue.put(update)
+
+    def handle_pre_checkout_query(update: telegram.Update, pre_checkout_query: telegram.PreCheckoutQuery):
         
-        if len(updates):
+        receiving_worker = get_worker(pre_checkout_query.from_user.id)
+        
+        if receiving_worker is None or \
+                pre_checkout_query.invoice_payload != receiving_worker.invoice_payload:
             
-            next_update = updates[-1].update_id + 1
+            log.debug("Received a pre-checkout query for an expired invoice in: %s", pre_checkout_query.from_user.id)
+            try:
+                bot.answer_pre_checkout_query(pre_checkout_query.id,
+                                              ok=False,
+                                              error_message=error_invoice_expired)
+            except telegram.error.BadRequest:
+                log.error("pre-checkout query expired before an answer could be sent!")
+            return
+        log.debug("Forwarding pre-checkout query to %s", receiving_worker)
+        
+        receiving_worker.queue.put(update)
+
+    
+    dispatch = (("message", handle_message),
+                ("callback_query", handle_callback_query),
+                ("pre_checkout_query", handle_pre_checkout_query))
+    # Telegram won't send, and the bot won't deserialize, any update type without a handler
+    allowed_updates = [field for field, _ in dispatch]
 
+    
+    backlog = False
+
+    
+    try:
+        while True:
+            
+            update_timeout = 0 if backlog else core_cfg.long_polling_timeout
+            log.debug("Getting updates from Telegram with a timeout of %s seconds", update_timeout)
+            updates = bot.get_updates(offset=next_update,
+                                      timeout=update_timeout,
+                                      limit=UPDATES_LIMIT,
+                                      allowed_updates=allowed_updates)
+            
+            backlog = len(updates) == UPDATES_LIMIT
+            
+            for update in updates:
+                
+                next_update = update.update_id + 1
+                for field, handler in dispatch:
+                    obj = getattr(update, field)
+                    if obj is not None:
+                        handler(update, obj)
+                        break
+    finally:
+        
+        with chat_workers_lock:
+            running_workers = list(chat_workers.values())
+        for running_worker in running_workers:
+            running_worker.queue.put(worker.StopSignal("shutdown"))
+            # Drops conversations still waiting for a free thread, as cancel_futures would need Python 3.9
+            running_worker.future.cancel()
+        executor.shutdown(wait=False)
+        sender.shutdown(wait=True)
 
 
 if __name__ == "__main__":
@@ -1,7 +1,6 @@
 import logging
 import typing
 
-import requests
 import telegram
 from sqlalchemy import Column, ForeignKey, UniqueConstraint
 from sqlalchemy import Integer, BigInteger, String, Text, LargeBinary, DateTime, Boolean
@@ -127,26 +126,29 @@ class Product(DeferredReflection, TableDeclarativeBase):
     def __repr__(self):
         return f"<Product {self.name}>"
 
-    def send_as_message(self, w: "worker.Worker", chat_id: int) -> dict:
-        """Send a message containing the product data."""
+    def send_as_message(self, w: "worker.Worker", chat_id: int,
+                        reply_markup: typing.Optional[telegram.ReplyMarkup] = None) -> dict:
+        """Send a message containing the product data, optionally with a keyboard attached."""
+        params = {"chat_id": chat_id,
+                  "parse_mode": "HTML"}
+        if reply_markup is not None:
+            params["reply_markup"] = reply_markup.to_json()
         if self.image is None:
-            r = requests.get(f"https://api.telegram.org/bot{w.cfg['Telegram']['token']}/sendMessage",
-                             params={"chat_id": chat_id,
-                                     "text": self.text(w),
-                                     "parse_mode": "HTML"})
+            params["text"] = self.text(w)
+            r = utils.http.get(f"https://api.telegram.org/bot{w.cfg['Telegram']['token']}/sendMessage",
+                             params=params)
         else:
-            r = requests.post(f"https://api.telegram.org/bot{w.cfg['Telegram']['token']}/sendPhoto",
+            params["caption"] = self.text(w)
+            r = utils.http.post(f"https://api.telegram.org/bot{w.cfg['Telegram']['token']}/sendPhoto",
                               files={"photo": self.image},
-                              params={"chat_id": chat_id,
-                                      "caption": self.text(w),
-                                      "parse_mode": "HTML"})
+                              params=params)
         return r.json()
 
     def set_image(self, file: telegram.File):
         """Download an image from Telegram and store it in the image column.
         This is a slow blocking function. Try to avoid calling it directly, use a thread if possible."""
         # Download the photo through a get request
-        r = requests.get(file.file_path)
+        r = utils.http.get(file.file_path)
         # Store the photo in the database record
         self.image = r.content
 
@@ -253,8 +255,7 @@ class Order(DeferredReflection, TableDeclarativeBase):
     def __repr__(self):
         return f"<Order {self.order_id} placed by User {self.user_id}>"
 
-    def text(self, w: "worker.Worker", session, user=False):
-        joined_self = session.query(Order).filter_by(order_id=self.order_id).join(Transaction).one()
+    def text(self, w: "worker.Worker", user=False):
         items = ""
         for item in self.items:
             items += item.text(w) + "\n"
@@ -273,7 +274,7 @@ class Order(DeferredReflection, TableDeclarativeBase):
                              status_text=status_text,
                              items=items,
                              notes=self.notes,
-                             value=str(w.Price(-joined_self.transaction.value))) + \
+                             value=str(w.Price(-self.transaction.value))) + \
                    (w.loc.get("refund_reason", reason=self.refund_reason) if self.refund_date is not None else "")
         else:
             return status_emoji + " " + \
@@ -283,7 +284,7 @@ class Order(DeferredReflection, TableDeclarativeBase):
                              date=self.creation_date.isoformat(),
                              items=items,
                              notes=self.notes if self.notes is not None else "",
-                             value=str(w.Price(-joined_self.transaction.value))) + \
+                             value=str(w.Price(-self.transaction.value))) + \
                    (w.loc.get("refund_reason", reason=self.refund_reason) if self.refund_date is not None else "")
 
 
@@ -4,6 +4,7 @@ import time
 import traceback
 
 import telegram.error
+import telegram.utils.request
 
 import nuconfig
 
@@ -24,6 +25,11 @@ def factory(cfg: nuconfig.NuConfig):
                 except telegram.error.Unauthorized:
                     log.debug(f"Unauthorized to call {func.__name__}(), skipping.")
                     break
+                # Flood limit hit, Telegram tells exactly how long to back off
+                except telegram.error.RetryAfter as error:
+                    log.warning(f"Flood limit hit while calling {func.__name__}(),"
+                                f" retrying in {error.retry_after} secs...")
+                    time.sleep(error.retry_after)
                 # Telegram API didn't answer in time
                 except telegram.error.TimedOut:
                     log.warning(f"Timed out while calling {func.__name__}(),"
@@ -55,7 +61,9 @@ def factory(cfg: nuconfig.NuConfig):
         return result_func
 
     class DuckBot:
-        def __init__(self, *args, **kwargs):
+        def __init__(self, *args, con_pool_size: int = 1, **kwargs):
+            # Every thread that may call the bot at the same time needs a connection of its own
+            kwargs.setdefault("request", telegram.utils.request.Request(con_pool_size=con_pool_size))
             self.bot = telegram.Bot(token=cfg["Telegram"]["token"], *args, **kwargs)
 
         @catch_telegram_errors
@@ -1,3 +1,4 @@
+import functools
 import importlib
 import json
 import logging
@@ -14,35 +15,60 @@ class IgnoreDict(dict):
         return "{" + key + "}"
 
 
+@functools.lru_cache(maxsize=32)
+def _import_strings(language: str) -> types.ModuleType:
+    """Import the strings module of a language, shared by every Localization using it."""
+    log.debug(f"Importing strings.{language}")
+    return importlib.import_module(f"strings.{language}")
+
+
 class Localization:
     def __init__(self, language: str, *, fallback: str, replacements: Dict[str, str] = None):
         log.debug(f"Creating localization for {language}")
         self.language: str = language
-        log.debug(f"Importing strings.{language}")
-        self.module: types.ModuleType = importlib.import_module(f"strings.{language}")
+        self.module: types.ModuleType = _import_strings(language)
         if language != fallback:
-            log.debug(f"Importing strings.{fallback} as fallback")
-            self.fallback_language: str = fallback
-            self.fallback_module = importlib.import_module(f"strings.{fallback}") if fallback else None
+            self.fallback_language: Optional[str] = fallback
         else:
-            log.debug("Language is the same as the default, not importing any fallback")
+            log.debug("Language is the same as the default, not using any fallback")
             self.fallback_language = None
-            self.fallback_module = None
         self.replacements: Dict[str, str] = replacements if replacements else {}
+        # Used to format strings requested without arguments, which only need the replacements
+        self._formatter = IgnoreDict(**self.replacements)
+        # Strings requested without arguments always format the same way, so they are only resolved once
+        self._cache: Dict[str, str] = {}
+
+    @property
+    def fallback_module(self) -> Optional[types.ModuleType]:
+        """The strings module of the fallback language, only imported once a string is missing."""
+        return _import_strings(self.fallback_language) if self.fallback_language else None
 
     def get(self, key: str, **kwargs) -> str:
+        if not kwargs:
+            cached = self._cache.get(key)
+            if cached is not None:
+                return cached
         try:
             log.debug(f"Getting localized string with key {key}")
             string = self.module.__getattribute__(key)
         except AttributeError:
-            if self.fallback_module:
+            fallback_module = self.fallback_module
+            if fallback_module:
                 log.warning(f"Missing localized string with key {key}, using default")
-                string = self.fallback_module.__getattribute__(key)
+                string = fallback_module.__getattribute__(key)
             else:
                 raise
         assert isinstance(string, str)
-        formatter = IgnoreDict(**self.replacements, **kwargs)
-        return string.format_map(formatter)
+        if "{" not in string and "}" not in string:
+            # Nothing to substitute or unescape
+            result = string
+        elif kwargs:
+            result = string.format_map(IgnoreDict(**self.replacements, **kwargs))
+        else:
+            result = string.format_map(self._formatter)
+        if not kwargs:
+            self._cache[key] = result
+        return result
 
     def boolmoji(self, boolean: bool) -> str:
         return self.get("emoji_yes") if boolean else self.get("emoji_no")
@@ -1,18 +1,29 @@
 import logging
 from typing import *
 
-import toml
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
+    import toml
 
 log = logging.getLogger(__name__)
 CompareReport = Dict[str, Union[str, List[str], "Missing"]]
 
 
+def load(file: "BinaryIO") -> dict:
+    """Parse a TOML file opened in binary mode, using the stdlib parser if it is available."""
+    if tomllib is not None:
+        return tomllib.load(file)
+    return toml.loads(file.read().decode("utf8"))
+
+
 class NuConfig:
-    def __init__(self, file: "TextIO"):
-        self.data = toml.load(file)
+    def __init__(self, source: Union[dict, "BinaryIO"]):
+        self.data = source if isinstance(source, dict) else load(source)
 
     def __getitem__(self, item):
-        return self.data.__getitem__(item)
+        return self.data[item]
 
     def cmplog(self, other) -> bool:
         """Compare two different NuConfig objects and log information about which keys are missing or invalid.
@@ -54,6 +54,9 @@ csv_caption = "A 📄 .csv file containing all transactions stored in the bot da
               "You can open this file with other programs, such as LibreOffice Calc, to process" \
               " the data."
 
+# transactions.csv was requested, but there are no transactions to export
+csv_empty = "There are no transactions yet, so there is nothing to export."
+
 # Conversation: the start command was sent and the bot should welcome the user
 conversation_after_start = "Hello!\n" \
                            "Welcome to greed!\n" \
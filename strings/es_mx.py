@@ -53,6 +53,9 @@ transactions_page = "Página <b>{page}</b>:\n" \
 csv_caption = "Un archivo 📄 .csv file que contiene todas las transacciones almacenadas en la base de datos del bot fue generado.\n" \
               "Puedes abrir este archivo con otros programas, como LibreOffice Calc, para procesar los datos."
 
+# transactions.csv was requested, but there are no transactions to export
+csv_empty = "Todavía no hay transacciones, así que no hay nada que exportar."
+
 # Conversation: the start command was sent and the bot should welcome the user
 conversation_after_start = "¡Hola!\n" \
                            "¡Bienvenido a greed!\n" \
@@ -52,6 +52,9 @@ csv_caption = "קובץ מסד נתונים עם כל פירוטי העסקאו
               "תוכל להשתמש במגוון כלי מסד נתונים כדי לפתוח קובץ זה" \
               " ולראות את כל הנתונים"
 
+# transactions.csv was requested, but there are no transactions to export
+csv_empty = "עדיין אין עסקאות, ולכן אין מה לייצא"
+
 # Conversation: the start command was sent and the bot should welcome the user
 conversation_after_start = "! היי וברוך הבא \n" \
                            "הלקוחות שלנו חשובים לנו ונשמח לעמוד לרשותכם לכל עת בעמוד הבית"
@@ -53,6 +53,9 @@ csv_caption = "E' stato generato un 📄 file .csv contenente tutte le transazio
               "E' possibile aprire questo file con altri programmi, come ad esempio LibreOffice Calc, per elaborare" \
               " i dati."
 
+# transactions.csv was requested, but there are no transactions to export
+csv_empty = "Non è ancora stata registrata alcuna transazione, quindi non c'è nulla da esportare."
+
 # Conversation: the start command was sent and the bot should welcome the user
 conversation_after_start = "Ciao!\n" \
                            "Benvenuto su greed!\n" \
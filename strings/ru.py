@@ -53,6 +53,9 @@ transactions_page = "Страница <b>{page}</b>:\n" \
 csv_caption = "Файл 📄 .csv сгенерирован, и содержит все транзакции из базы данных бота.\n" \
               "Вы можете открыть этот файт с помощью LibreOffice Calc, чтобы просмотреть детали."
 
+# transactions.csv was requested, but there are no transactions to export
+csv_empty = "Транзакций пока нет, поэтому экспортировать нечего."
+
 # Conversation: the start command was sent and the bot should welcome the user
 conversation_after_start = "Привет!\n" \
                            "Добро пожаловать в greed!\n" \
@@ -53,6 +53,9 @@ transactions_page = "Сторінка <b>{page}</b>:\n" \
 csv_caption = "Файл 📄 .csv, який має всі транзакції з бази даних бота було сгенеровано.\n" \
               "Можете відкрити файл за допомогою LibreOffice Calc, щоб переглянути деталі."
 
+# transactions.csv was requested, but there are no transactions to export
+csv_empty = "Транзакцій поки немає, тому експортувати нічого."
+
 # Conversation: the start command was sent and the bot should welcome the user
 conversation_after_start = "Привіт!\n" \
                            "Вітаю в greed!\n" \
@@ -53,6 +53,9 @@ transactions_page = "Page <b>{page}</b>:\n" \
 csv_caption = "生成了一个📄.csv文件,其中包含bot的数据库中多所有事物\n" \
               "您可以使用其他程序(例如LibreOffice Calc)打开此文件并进行处理数据" \
  \
+# transactions.csv was requested, but there are no transactions to export
+csv_empty = "目前还没有任何交易,因此没有可导出的内容"
+
 # Conversation: the start command was sent and the bot should welcome the user
 conversation_after_start = "您好!\n" \
                            "欢迎使用greed系统!\n" \
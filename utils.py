@@ -1,3 +1,18 @@
+import requests
+import requests.adapters
+import urllib3.util.retry
+
+# Shared HTTP session, so that raw Bot API calls and file downloads reuse keep-alive connections
+http = requests.Session()
+# Keep enough connections for several workers at once, and retry requests that failed before reaching Telegram;
+# reads are not retried, as the request may already have been acted upon
+http.mount("https://", requests.adapters.HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=16,
+    max_retries=urllib3.util.retry.Retry(connect=3, read=0, backoff_factor=0.2),
+))
+
+
 def telegram_html_escape(string: str):
     return string.replace("<", "&lt;") \
         .replace(">", "&gt;") \
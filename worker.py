@@ -1,16 +1,21 @@
+import concurrent.futures
+import csv
 import datetime
+import functools
 import logging
+import operator
 import os
 import queue as queuem
 import re
 import sys
+import tempfile
 import threading
+import time
 import traceback
 import uuid
 from html import escape
 from typing import *
 
-import requests
 import sqlalchemy.orm
 import telegram
 
@@ -20,6 +25,59 @@ import nuconfig
 
 log = logging.getLogger(__name__)
 
+# Languages that can be picked from the language menu, in the order they are displayed
+LANGUAGES = (
+    ("it", "🇮🇹 Italiano"),
+    ("en", "🇬🇧 English"),
+    ("ru", "🇷🇺 Русский"),
+    ("uk", "🇺🇦 Українська"),
+    ("zh_cn", "🇨🇳 简体中文"),
+    ("he", "🇮🇱 עברית"),
+    ("es_mx", "🇲🇽 Español"),
+)
+
+
+@functools.lru_cache(maxsize=8)
+def _build_lang_menu(enabled: FrozenSet[str]) -> Tuple[telegram.ReplyKeyboardMarkup, Dict[str, str]]:
+    """Build the language selection keyboard and the label to code mapping for the given enabled languages.
+
+    Both are shared between every worker with the same configuration and must not be modified."""
+    options = {label: code for code, label in LANGUAGES if code in enabled}
+    keyboard = [[telegram.KeyboardButton(label)] for label in options]
+    return telegram.ReplyKeyboardMarkup(keyboard, one_time_keyboard=True), options
+
+# Keyboard markups carry no state, so the same one can be sent to every chat
+REMOVE_KEYBOARD = telegram.ReplyKeyboardRemove()
+
+# Patterns of the fixed-format answers waited for with __wait_for_regex
+_LINE_RE = re.compile(r"(.*)")
+_PRICE_RE = re.compile(r"([0-9]+(?:[.,][0-9]{1,2})?|[Xx])")
+_CREDIT_RE = re.compile(r"(-? ?[0-9]{1,3}(?:[.,][0-9]{1,2})?)")
+
+# Seconds without cart clicks after which the order menu edits its summary message
+_CART_SUMMARY_DELAY = 0.5
+
+# Date of the last formatted {today} replacement, along with its text
+_today_cache: Tuple[Optional[datetime.date], str] = (None, "")
+
+
+def _today_str() -> str:
+    """Return today's date formatted for the {today} replacement, formatting it only once per day."""
+    global _today_cache
+    today = datetime.date.today()
+    if _today_cache[0] != today:
+        # A single reference swap, so concurrent workers can at worst format the same date twice
+        _today_cache = (today, today.strftime("%a %d %b %Y"))
+    return _today_cache[1]
+
+
+# Shared by all workers for blocking calls that can overlap, such as messages to several different chats
+IO_THREADS = 8
+_io_pool = concurrent.futures.ThreadPoolExecutor(max_workers=IO_THREADS, thread_name_prefix="IO")
+# Admin exports get their own threads, so that a large upload can't hold up the order notifications on _io_pool
+UPLOAD_THREADS = 2
+_upload_pool = concurrent.futures.ThreadPoolExecutor(max_workers=UPLOAD_THREADS, thread_name_prefix="Upload")
+
 
 class StopSignal:
     def __init__(self, reason: str = ""):
@@ -30,27 +88,91 @@ class CancelSignal:
     pass
 
 
-class Worker(threading.Thread):
+class ConversationStopped(BaseException):
+    """Unwinds a stopped conversation back to Worker.run.
+
+    Not an Exception, so that the handlers of the conversation itself don't catch it."""
+
+
+class CartLine:
+    """A product shown in the order menu, along with the quantity of it in the cart."""
+    __slots__ = ("product", "message_id", "is_photo", "qty")
+
+    def __init__(self, product: db.Product, message_id: int, is_photo: bool, qty: int = 0):
+        self.product: db.Product = product
+        self.message_id: int = message_id
+        self.is_photo: bool = is_photo
+        self.qty: int = qty
+
+
+def _scan_digits(text: str, start: int) -> int:
+    """Return the index right after the run of ASCII digits beginning at start."""
+    end = start
+    while end < len(text) and "0" <= text[end] <= "9":
+        end += 1
+    return end
+
+
+def _scan_user_id(text: str) -> Optional[int]:
+    """Find the first user_<digits> tag in the text, as produced by User.identifiable_str."""
+    start = text.find("user_")
+    while start != -1:
+        end = _scan_digits(text, start + 5)
+        if end > start + 5:
+            return int(text[start + 5:end])
+        start = text.find("user_", start + 5)
+    return None
+
+
+def _scan_amount(text: str) -> Optional[str]:
+    """Find the first decimal amount in the text, allowing either a dot or a comma as separator."""
+    for start, char in enumerate(text):
+        if "0" <= char <= "9":
+            break
+    else:
+        return None
+    end = _scan_digits(text, start)
+    if end + 1 < len(text) and text[end] in ".," and "0" <= text[end + 1] <= "9":
+        end = _scan_digits(text, end + 1)
+    return text[start:end]
+
+
+class Worker:
     def __init__(self,
                  bot,
                  chat: telegram.Chat,
                  telegram_user: telegram.User,
                  cfg: nuconfig.NuConfig,
-                 engine,
-                 *args,
-                 **kwargs):
-        super().__init__(name=f"Worker {chat.id}", *args, **kwargs)
+                 session_factory: sqlalchemy.orm.scoped_session):
+        self.name = f"Worker {chat.id}"
+        self.future: Optional[concurrent.futures.Future] = None
         self.bot = bot
         self.chat: telegram.Chat = chat
         self.telegram_user: telegram.User = telegram_user
         self.cfg = cfg
         self.loc = None
-        log.debug(f"Opening new database session for {self.name}")
-        self.session = sqlalchemy.orm.sessionmaker(bind=engine)()
+        self.cancel_text = None
+        self.session_factory = session_factory
+        self.session: Optional[sqlalchemy.orm.Session] = None
         self.user: Optional[db.User] = None
         self.admin: Optional[db.Admin] = None
-        self.queue = queuem.Queue()
+        self.queue = queuem.SimpleQueue()
+        # When the conversation last received anything, used by core to pick which one to end when it's full
+        self.last_update: float = time.monotonic()
         self.invoice_payload = None
+        self._conversation_timeout = cfg["Telegram"]["conversation_timeout"]
+        self._cc_fee_rate = cfg["Payments"]["CreditCard"]["fee_percentage"] / 100
+        self._cc_fee_fixed = cfg["Payments"]["CreditCard"]["fee_fixed"]
+        # Interned like the language of the user, so equal codes are shared objects; lookups still hash them
+        self._enabled_languages: FrozenSet[str] = frozenset(map(sys.intern, cfg["Language"]["enabled_languages"]))
+        self._default_language: str = sys.intern(cfg["Language"]["default_language"])
+        self._fallback_language: str = sys.intern(cfg["Language"]["fallback_language"])
+        # Localization replacements, along with the user fields and date they were built from
+        self._replacements_key: Optional[tuple] = None
+        self._replacements: Dict[str, str] = {}
+        # Looked up on every Price operation, so resolve them once per conversation
+        self._currency_scale = 10 ** cfg["Payments"]["currency_exp"]
+        self._currency_symbol = cfg["Payments"]["currency_symbol"]
         self.Price = self.price_factory()
 
     def __repr__(self):
@@ -58,14 +180,15 @@ class Worker(threading.Thread):
 
     def price_factory(worker):
         class Price:
+            __slots__ = ("value",)
 
             def __init__(self, value: Union[int, float, str, "Price"]):
                 if isinstance(value, int):
                     self.value = int(value)
                 elif isinstance(value, float):
-                    self.value = int(value * (10 ** worker.cfg["Payments"]["currency_exp"]))
+                    self.value = int(value * worker._currency_scale)
                 elif isinstance(value, str):
-                    self.value = int(float(value.replace(",", ".")) * (10 ** worker.cfg["Payments"]["currency_exp"]))
+                    self.value = int(float(value.replace(",", ".")) * worker._currency_scale)
                 elif isinstance(value, Price):
                     self.value = value.value
 
@@ -73,38 +196,35 @@ class Worker(threading.Thread):
                 return f"<{self.__class__.__qualname__} of value {self.value}>"
 
             def __str__(self):
-                return worker.loc.get(
-                    "currency_format_string",
-                    symbol=worker.cfg["Payments"]["currency_symbol"],
-                    value="{0:.2f}".format(self.value / (10 ** worker.cfg["Payments"]["currency_exp"]))
-                )
+                return worker._currency_fmt.format(symbol=worker._currency_symbol,
+                                                   value="{0:.2f}".format(self.value / worker._currency_scale))
 
             def __int__(self):
                 return self.value
 
             def __float__(self):
-                return self.value / (10 ** worker.cfg["Payments"]["currency_exp"])
+                return self.value / worker._currency_scale
 
             def __ge__(self, other):
-                return self.value >= Price(other).value
+                return self.value >= value_of(other)
 
             def __le__(self, other):
-                return self.value <= Price(other).value
+                return self.value <= value_of(other)
 
             def __eq__(self, other):
-                return self.value == Price(other).value
+                return self.value == value_of(other)
 
             def __gt__(self, other):
-                return self.value > Price(other).value
+                return self.value > value_of(other)
 
             def __lt__(self, other):
-                return self.value < Price(other).value
+                return self.value < value_of(other)
 
             def __add__(self, other):
-                return Price(self.value + Price(other).value)
+                return Price(self.value + value_of(other))
 
             def __sub__(self, other):
-                return Price(self.value - Price(other).value)
+                return Price(self.value - value_of(other))
 
             def __mul__(self, other):
                 return Price(int(self.value * other))
@@ -116,17 +236,17 @@ class Worker(threading.Thread):
                 return self.__add__(other)
 
             def __rsub__(self, other):
-                return Price(Price(other).value - self.value)
+                return Price(value_of(other) - self.value)
 
             def __rmul__(self, other):
                 return self.__mul__(other)
 
             def __iadd__(self, other):
-                self.value += Price(other).value
+                self.value += value_of(other)
                 return self
 
             def __isub__(self, other):
-                self.value -= Price(other).value
+                self.value -= value_of(other)
                 return self
 
             def __imul__(self, other):
@@ -138,10 +258,39 @@ class Worker(threading.Thread):
                 self.value //= other
                 return self
 
+        def value_of(other) -> int:
+            # Most operands are already Prices or plain ints, which need no conversion
+            if type(other) is Price:
+                return other.value
+            if type(other) is int:
+                return other
+            return Price(other).value
+
         return Price
 
+    def start(self, executor: concurrent.futures.Executor):
+        
+        self.future = executor.submit(self.run)
+
     def run(self):
         
+        threading.current_thread().name = self.name
+        # The session is scoped to the pool thread running the conversation, and released when it ends
+        log.debug("Opening new database session")
+        self.session = self.session_factory()
+        try:
+            self.__conversation()
+        except ConversationStopped:
+            log.debug("Conversation stopped")
+        except Exception as e:
+            # Otherwise it would only be stored on the future, which nothing reads
+            log.error(f"Unhandled exception in {self}: {e}")
+            traceback.print_exception(*sys.exc_info())
+        finally:
+            self.session_factory.remove()
+
+    def __conversation(self):
+        
         log.debug("Starting conversation")
         
         self.user = self.session.query(db.User).filter(db.User.user_id == self.chat.id).one_or_none()
@@ -155,10 +304,9 @@ class Worker(threading.Thread):
             
             self.session.add(self.user)
             
-            self.session.flush()
-            
             if will_be_owner:
                 
+                # The user id comes from Telegram, so no flush is needed to know it before the commit
                 self.admin = db.Admin(user_id=self.user.user_id,
                                       edit_products=True,
                                       receive_orders=True,
@@ -187,9 +335,11 @@ class Worker(threading.Thread):
             
             else:
                 
-                self.admin.live_mode = False
-                
-                self.session.commit()
+                # Only write when the previous conversation left live mode on
+                if self.admin.live_mode:
+                    self.admin.live_mode = False
+                    
+                    self.session.commit()
                 
                 self.__admin_menu()
         except Exception as e:
@@ -211,7 +361,8 @@ class Worker(threading.Thread):
         
         self.queue.put(StopSignal(reason))
         
-        self.join()
+        if not self.future.cancel():
+            concurrent.futures.wait([self.future])
 
     def update_user(self) -> db.User:
         
@@ -220,15 +371,19 @@ class Worker(threading.Thread):
         return self.user
 
     
-    def __receive_next_update(self) -> telegram.Update:
-        
+    def __receive_next_update(self, timeout: Optional[float] = None) -> Optional[telegram.Update]:
         
+        # With a timeout, None is returned when nothing arrives in time instead of ending the conversation
         try:
-            data = self.queue.get(timeout=self.cfg["Telegram"]["conversation_timeout"])
+            data = self.queue.get(timeout=self._conversation_timeout if timeout is None else timeout)
         except queuem.Empty:
+            if timeout is not None:
+                return None
             
             self.__graceful_stop(StopSignal("timeout"))
         
+        self.last_update = time.monotonic()
+        
         if isinstance(data, StopSignal):
             
             self.__graceful_stop(data)
@@ -236,10 +391,13 @@ class Worker(threading.Thread):
         return data
 
     def __wait_for_specific_message(self,
-                                    items: List[str],
+                                    items: Collection[str],
                                     cancellable: bool = False) -> Union[str, CancelSignal]:
         
         log.debug("Waiting for a specific message...")
+        # Checked against every incoming message, so make the lookup a hash instead of a scan
+        if not isinstance(items, (set, frozenset)):
+            items = frozenset(items)
         while True:
             
             update = self.__receive_next_update()
@@ -264,7 +422,31 @@ class Worker(threading.Thread):
             
             return update.message.text
 
-    def __wait_for_regex(self, regex: str, cancellable: bool = False) -> Union[str, CancelSignal]:
+    def __wait_for_text(self, cancellable: bool = False) -> Union[str, CancelSignal]:
+        
+        log.debug("Waiting for a text message...")
+        while True:
+            
+            update = self.__receive_next_update()
+            
+            if isinstance(update, CancelSignal):
+                
+                if cancellable:
+                    
+                    return update
+                else:
+                    
+                    continue
+            
+            if update.message is None:
+                continue
+            
+            if update.message.text is None:
+                continue
+            
+            return update.message.text
+
+    def __wait_for_regex(self, regex: Pattern, cancellable: bool = False) -> Union[str, CancelSignal]:
         
         log.debug("Waiting for a regex...")
         while True:
@@ -286,13 +468,71 @@ class Worker(threading.Thread):
             if update.message.text is None:
                 continue
             
-            match = re.search(regex, update.message.text)
+            match = regex.search(update.message.text)
             
             if match is None:
                 continue
             
             return match.group(1)
 
+    def __wait_for_user_id(self, cancellable: bool = False) -> Union[int, CancelSignal]:
+        
+        log.debug("Waiting for a user id...")
+        while True:
+            
+            update = self.__receive_next_update()
+            
+            if isinstance(update, CancelSignal):
+                
+                if cancellable:
+                    
+                    return update
+                else:
+                    
+                    continue
+            
+            if update.message is None:
+                continue
+            
+            if update.message.text is None:
+                continue
+            
+            user_id = _scan_user_id(update.message.text)
+            
+            if user_id is None:
+                continue
+            
+            return user_id
+
+    def __wait_for_amount(self, cancellable: bool = False) -> Union[str, CancelSignal]:
+        
+        log.debug("Waiting for an amount...")
+        while True:
+            
+            update = self.__receive_next_update()
+            
+            if isinstance(update, CancelSignal):
+                
+                if cancellable:
+                    
+                    return update
+                else:
+                    
+                    continue
+            
+            if update.message is None:
+                continue
+            
+            if update.message.text is None:
+                continue
+            
+            amount = _scan_amount(update.message.text)
+            
+            if amount is None:
+                continue
+            
+            return amount
+
     def __wait_for_precheckoutquery(self,
                                     cancellable: bool = False) -> Union[telegram.PreCheckoutQuery, CancelSignal]:
         
@@ -364,13 +604,17 @@ class Worker(threading.Thread):
             
             return update.message.photo
 
-    def __wait_for_inlinekeyboard_callback(self, cancellable: bool = False) \
-            -> Union[telegram.CallbackQuery, CancelSignal]:
+    def __wait_for_inlinekeyboard_callback(self, cancellable: bool = False, timeout: Optional[float] = None) \
+            -> Union[telegram.CallbackQuery, CancelSignal, None]:
         
         log.debug("Waiting for a CallbackQuery...")
         while True:
             
-            update = self.__receive_next_update()
+            update = self.__receive_next_update(timeout)
+            
+            if update is None:
+                
+                return None
             
             if isinstance(update, CancelSignal):
                 
@@ -405,12 +649,12 @@ class Worker(threading.Thread):
             
             self.bot.send_message(self.chat.id, self.loc.get("conversation_admin_select_user"), reply_markup=keyboard)
             
-            reply = self.__wait_for_regex("user_([0-9]+)", cancellable=True)
+            reply = self.__wait_for_user_id(cancellable=True)
             
             if isinstance(reply, CancelSignal):
                 return reply
             
-            user = self.session.query(db.User).filter_by(user_id=int(reply)).one_or_none()
+            user = self.session.query(db.User).filter_by(user_id=reply).one_or_none()
             
             if not user:
                 self.bot.send_message(self.chat.id, self.loc.get("error_user_does_not_exist"))
@@ -423,43 +667,35 @@ class Worker(threading.Thread):
         
         while True:
             
-            keyboard = [[telegram.KeyboardButton(self.loc.get("menu_order"))],
-                        [telegram.KeyboardButton(self.loc.get("menu_order_status"))],
-                        [telegram.KeyboardButton(self.loc.get("menu_add_credit"))],
-                        [telegram.KeyboardButton(self.loc.get("menu_language"))],
-                        [telegram.KeyboardButton(self.loc.get("menu_help"))]]
-            
             self.bot.send_message(self.chat.id,
                                   self.loc.get("conversation_open_user_menu",
                                                credit=self.Price(self.user.credit)),
-                                  reply_markup=telegram.ReplyKeyboardMarkup(keyboard, one_time_keyboard=True))
+                                  reply_markup=self._user_menu_kb)
             
-            selection = self.__wait_for_specific_message([
-                self.loc.get("menu_order"),
-                self.loc.get("menu_order_status"),
-                self.loc.get("menu_add_credit"),
-                self.loc.get("menu_language"),
-                self.loc.get("menu_help")])
+            selection = self.__wait_for_specific_message(self._user_menu_items)
             
             self.update_user()
             
-            if selection == self.loc.get("menu_order"):
+            # Re-read after the wait, as __language_menu rebuilds the labels
+            t = self._t
+            
+            if selection == t["menu_order"]:
                 
                 self.__order_menu()
             
-            elif selection == self.loc.get("menu_order_status"):
+            elif selection == t["menu_order_status"]:
                 
                 self.__order_status()
             
-            elif selection == self.loc.get("menu_add_credit"):
+            elif selection == t["menu_add_credit"]:
                 
                 self.__add_credit_menu()
             
-            elif selection == self.loc.get("menu_language"):
+            elif selection == t["menu_language"]:
                 
                 self.__language_menu()
             
-            elif selection == self.loc.get("menu_help"):
+            elif selection == t["menu_help"]:
                 
                 self.__help_menu()
 
@@ -470,41 +706,46 @@ class Worker(threading.Thread):
         products = self.session.query(db.Product).filter_by(deleted=False).all()
         
         
-        cart: Dict[List[db.Product, int]] = {}
+        cart: Dict[int, CartLine] = {}
+        # Number of cart lines with a nonzero quantity, which decides whether "Done" is offered
+        nonzero_lines = 0
         
         for product in products:
             
             if product.price is None:
                 continue
             
-            message = product.send_as_message(w=self, chat_id=self.chat.id)
-            
-            cart[message['result']['message_id']] = [product, 0]
-            
-            inline_keyboard = telegram.InlineKeyboardMarkup(
-                [[telegram.InlineKeyboardButton(self.loc.get("menu_add_to_cart"), callback_data="cart_add")]]
-            )
+            message = product.send_as_message(w=self, chat_id=self.chat.id, reply_markup=self._add_only_kb)
             
-            if product.image is None:
-                self.bot.edit_message_text(chat_id=self.chat.id,
-                                           message_id=message['result']['message_id'],
-                                           text=product.text(w=self),
-                                           reply_markup=inline_keyboard)
-            else:
-                self.bot.edit_message_caption(chat_id=self.chat.id,
-                                              message_id=message['result']['message_id'],
-                                              caption=product.text(w=self),
-                                              reply_markup=inline_keyboard)
-        
-        inline_keyboard = telegram.InlineKeyboardMarkup([[telegram.InlineKeyboardButton(self.loc.get("menu_cancel"),
-                                                                                        callback_data="cart_cancel")]])
+            message_id = message['result']['message_id']
+            cart[message_id] = CartLine(product=product, message_id=message_id, is_photo=product.image is not None)
         
         final_msg = self.bot.send_message(self.chat.id,
                                           self.loc.get("conversation_cart_actions"),
-                                          reply_markup=inline_keyboard)
+                                          reply_markup=self._cart_empty_kb)
+        
+        # Set when the summary message is behind the cart; it is only edited once the clicks stop for
+        # _CART_SUMMARY_DELAY seconds, so that a burst of taps results in a single edit
+        summary_dirty = False
+        
+        # Bound once, as they are used on every click
+        chat_id = self.chat.id
+        edit_message_text = self.bot.edit_message_text
+        edit_message_caption = self.bot.edit_message_caption
         
         while True:
-            callback = self.__wait_for_inlinekeyboard_callback()
+            callback = self.__wait_for_inlinekeyboard_callback(timeout=_CART_SUMMARY_DELAY if summary_dirty else None)
+            
+            if callback is None:
+                edit_message_text(
+                    chat_id=chat_id,
+                    message_id=final_msg.message_id,
+                    text=self.loc.get("conversation_confirm_cart",
+                                      product_list=self.__get_cart_summary(cart),
+                                      total_cost=str(self.__get_cart_value(cart))),
+                    reply_markup=self._cart_ready_kb if nonzero_lines > 0 else self._cart_empty_kb)
+                summary_dirty = False
+                continue
             
             
             if callback.data == "cart_cancel":
@@ -513,120 +754,83 @@ class Worker(threading.Thread):
             
             elif callback.data == "cart_add":
                 
-                p = cart.get(callback.message.message_id)
-                if p is None:
+                line = cart.get(callback.message.message_id)
+                if line is None:
                     continue
-                product = p[0]
-                
-                cart[callback.message.message_id][1] += 1
-                
-                product_inline_keyboard = telegram.InlineKeyboardMarkup(
-                    [
-                        [telegram.InlineKeyboardButton(self.loc.get("menu_add_to_cart"),
-                                                       callback_data="cart_add"),
-                         telegram.InlineKeyboardButton(self.loc.get("menu_remove_from_cart"),
-                                                       callback_data="cart_remove")]
-                    ])
-                
-                final_inline_keyboard = telegram.InlineKeyboardMarkup(
-                    [
-                        [telegram.InlineKeyboardButton(self.loc.get("menu_cancel"), callback_data="cart_cancel")],
-                        [telegram.InlineKeyboardButton(self.loc.get("menu_done"), callback_data="cart_done")]
-                    ])
-                
-                if product.image is None:
-                    self.bot.edit_message_text(chat_id=self.chat.id,
-                                               message_id=callback.message.message_id,
-                                               text=product.text(w=self,
-                                                                 cart_qty=cart[callback.message.message_id][1]),
-                                               reply_markup=product_inline_keyboard)
+                
+                if line.qty == 0:
+                    nonzero_lines += 1
+                line.qty += 1
+                
+                product_inline_keyboard = self._add_remove_kb
+                
+                if not line.is_photo:
+                    edit_message_text(chat_id=chat_id,
+                                      message_id=line.message_id,
+                                      text=line.product.text(w=self, cart_qty=line.qty),
+                                      reply_markup=product_inline_keyboard)
                 else:
-                    self.bot.edit_message_caption(chat_id=self.chat.id,
-                                                  message_id=callback.message.message_id,
-                                                  caption=product.text(w=self,
-                                                                       cart_qty=cart[callback.message.message_id][1]),
-                                                  reply_markup=product_inline_keyboard)
-
-                self.bot.edit_message_text(
-                    chat_id=self.chat.id,
-                    message_id=final_msg.message_id,
-                    text=self.loc.get("conversation_confirm_cart",
-                                      product_list=self.__get_cart_summary(cart),
-                                      total_cost=str(self.__get_cart_value(cart))),
-                    reply_markup=final_inline_keyboard)
+                    edit_message_caption(chat_id=chat_id,
+                                         message_id=line.message_id,
+                                         caption=line.product.text(w=self, cart_qty=line.qty),
+                                         reply_markup=product_inline_keyboard)
+                
+                summary_dirty = True
             
             elif callback.data == "cart_remove":
                 
-                p = cart.get(callback.message.message_id)
-                if p is None:
+                line = cart.get(callback.message.message_id)
+                if line is None:
                     continue
-                product = p[0]
                 
-                if cart[callback.message.message_id][1] > 0:
-                    cart[callback.message.message_id][1] -= 1
+                if line.qty > 0:
+                    line.qty -= 1
                 else:
                     continue
                 
-                product_inline_list = [[telegram.InlineKeyboardButton(self.loc.get("menu_add_to_cart"),
-                                                                      callback_data="cart_add")]]
-                if cart[callback.message.message_id][1] > 0:
-                    product_inline_list[0].append(telegram.InlineKeyboardButton(self.loc.get("menu_remove_from_cart"),
-                                                                                callback_data="cart_remove"))
-                product_inline_keyboard = telegram.InlineKeyboardMarkup(product_inline_list)
-                
-                final_inline_list = [[telegram.InlineKeyboardButton(self.loc.get("menu_cancel"),
-                                                                    callback_data="cart_cancel")]]
-                for product_id in cart:
-                    if cart[product_id][1] > 0:
-                        final_inline_list.append([telegram.InlineKeyboardButton(self.loc.get("menu_done"),
-                                                                                callback_data="cart_done")])
-                        break
-                final_inline_keyboard = telegram.InlineKeyboardMarkup(final_inline_list)
-                
-                if product.image is None:
-                    self.bot.edit_message_text(chat_id=self.chat.id, message_id=callback.message.message_id,
-                                               text=product.text(w=self,
-                                                                 cart_qty=cart[callback.message.message_id][1]),
-                                               reply_markup=product_inline_keyboard)
+                if line.qty > 0:
+                    product_inline_keyboard = self._add_remove_kb
                 else:
-                    self.bot.edit_message_caption(chat_id=self.chat.id,
-                                                  message_id=callback.message.message_id,
-                                                  caption=product.text(w=self,
-                                                                       cart_qty=cart[callback.message.message_id][1]),
-                                                  reply_markup=product_inline_keyboard)
-
-                self.bot.edit_message_text(
-                    chat_id=self.chat.id,
-                    message_id=final_msg.message_id,
-                    text=self.loc.get("conversation_confirm_cart",
-                                      product_list=self.__get_cart_summary(cart),
-                                      total_cost=str(self.__get_cart_value(cart))),
-                    reply_markup=final_inline_keyboard)
+                    nonzero_lines -= 1
+                    product_inline_keyboard = self._add_only_kb
+                
+                if not line.is_photo:
+                    edit_message_text(chat_id=chat_id,
+                                      message_id=line.message_id,
+                                      text=line.product.text(w=self, cart_qty=line.qty),
+                                      reply_markup=product_inline_keyboard)
+                else:
+                    edit_message_caption(chat_id=chat_id,
+                                         message_id=line.message_id,
+                                         caption=line.product.text(w=self, cart_qty=line.qty),
+                                         reply_markup=product_inline_keyboard)
+                
+                summary_dirty = True
             
             elif callback.data == "cart_done":
                 
+                # A summary that has not been refreshed yet may still offer "Done" for an emptied cart
+                if nonzero_lines == 0:
+                    continue
                 break
         
-        cancel = telegram.InlineKeyboardMarkup([[telegram.InlineKeyboardButton(self.loc.get("menu_skip"),
-                                                                               callback_data="cmd_cancel")]])
-        
-        self.bot.send_message(self.chat.id, self.loc.get("ask_order_notes"), reply_markup=cancel)
+        self.bot.send_message(self.chat.id, self.loc.get("ask_order_notes"), reply_markup=self._skip_inline)
         
-        notes = self.__wait_for_regex(r"(.*)", cancellable=True)
+        notes = self.__wait_for_text(cancellable=True)
         
         order = db.Order(user=self.user,
-                         creation_date=datetime.datetime.now(),
+                         creation_date=sqlalchemy.func.now(),
                          notes=notes if not isinstance(notes, CancelSignal) else "")
         
         self.session.add(order)
         self.session.flush()
         
-        for product in cart:
-            
-            for i in range(0, cart[product][1]):
-                order_item = db.OrderItem(product=cart[product][0],
-                                          order_id=order.order_id)
-                self.session.add(order_item)
+        # Insert every unit of every product with a single executemany instead of one ORM object per unit
+        order_items = [{"product_id": line.product.id, "order_id": order.order_id}
+                       for line in cart.values()
+                       for _ in range(line.qty)]
+        if order_items:
+            self.session.execute(db.OrderItem.__table__.insert(), order_items)
         
         credit_required = self.__get_cart_value(cart) - self.user.credit
         
@@ -649,20 +853,16 @@ class Worker(threading.Thread):
 
     def __get_cart_value(self, cart):
         
-        value = self.Price(0)
-        for product in cart:
-            value += cart[product][0].price * cart[product][1]
-        return value
+        # Product prices are stored as integers in the smallest currency unit, so sum them as such
+        value = 0
+        for line in cart.values():
+            value += line.product.price * line.qty
+        return self.Price(value)
 
     def __get_cart_summary(self, cart):
         
-        product_list = ""
-        for product_id in cart:
-            if cart[product_id][1] > 0:
-                product_list += cart[product_id][0].text(w=self,
-                                                         style="short",
-                                                         cart_qty=cart[product_id][1]) + "\n"
-        return product_list
+        return "".join(line.product.text(w=self, style="short", cart_qty=line.qty) + "\n"
+                       for line in cart.values() if line.qty > 0)
 
     def __order_transaction(self, order, value):
         
@@ -671,8 +871,7 @@ class Worker(threading.Thread):
                                      order_id=order.order_id)
         self.session.add(transaction)
         
-        self.session.commit()
-        
+        # Autoflush puts the new transaction in the database before the credit is summed, so one commit is enough
         self.user.recalculate_credit()
         
         self.session.commit()
@@ -682,28 +881,31 @@ class Worker(threading.Thread):
     def __order_notify_admins(self, order):
         
         self.bot.send_message(self.chat.id, self.loc.get("success_order_created", order=order.text(w=self,
-                                                                                                   session=self.session,
                                                                                                    user=True)))
         
         admins = self.session.query(db.Admin).filter_by(live_mode=True).all()
         
-        order_keyboard = telegram.InlineKeyboardMarkup(
-            [
-                [telegram.InlineKeyboardButton(self.loc.get("menu_complete"), callback_data="order_complete")],
-                [telegram.InlineKeyboardButton(self.loc.get("menu_refund"), callback_data="order_refund")]
-            ])
-        
-        for admin in admins:
-            self.bot.send_message(admin.user_id,
-                                  self.loc.get('notification_order_placed',
-                                               order=order.text(w=self, session=self.session)),
-                                  reply_markup=order_keyboard)
+        # The text is rendered once here, as it needs the session, while the sends to the admins run in parallel
+        notification_text = self.loc.get('notification_order_placed', order=order.text(w=self))
+        notifications = [_io_pool.submit(self.bot.send_message,
+                                         admin.user_id,
+                                         notification_text,
+                                         reply_markup=self._order_inline)
+                         for admin in admins]
+        for notification in concurrent.futures.as_completed(notifications):
+            try:
+                notification.result()
+            except Exception as e:
+                log.warning(f"Failed to notify an admin of {order}: {e}")
 
     def __order_status(self):
         
         log.debug("Displaying __order_status")
         
+        # Load the items, their products and the transactions up front, instead of lazily once per order
         orders = self.session.query(db.Order) \
+            .options(sqlalchemy.orm.selectinload(db.Order.items).joinedload(db.OrderItem.product),
+                     sqlalchemy.orm.joinedload(db.Order.transaction)) \
             .filter(db.Order.user == self.user) \
             .order_by(db.Order.creation_date.desc()) \
             .limit(20) \
@@ -713,7 +915,7 @@ class Worker(threading.Thread):
             self.bot.send_message(self.chat.id, self.loc.get("error_no_orders"))
         
         for order in orders:
-            self.bot.send_message(self.chat.id, order.text(w=self, session=self.session, user=True))
+            self.bot.send_message(self.chat.id, order.text(w=self, user=True))
         
 
     def __add_credit_menu(self):
@@ -765,8 +967,8 @@ class Worker(threading.Thread):
             self.bot.send_message(self.chat.id, self.loc.get("payment_cc_amount"),
                                   reply_markup=telegram.ReplyKeyboardMarkup(keyboard, one_time_keyboard=True))
             
-            selection = self.__wait_for_regex(r"([0-9]+(?:[.,][0-9]+)?|" + self.loc.get("menu_cancel") + r")",
-                                              cancellable=True)
+            # The cancel button is turned into a CancelSignal by core, so only amounts need to be parsed here
+            selection = self.__wait_for_amount(cancellable=True)
             
             if isinstance(selection, CancelSignal):
                 
@@ -795,7 +997,7 @@ class Worker(threading.Thread):
 
     def __make_payment(self, amount):
         
-        self.invoice_payload = str(uuid.uuid4())
+        self.invoice_payload = uuid.uuid4().hex
         
         prices = [telegram.LabeledPrice(label=self.loc.get("payment_invoice_label"), amount=int(amount))]
         
@@ -849,70 +1051,69 @@ class Worker(threading.Thread):
 
     def __get_total_fee(self, amount):
         
-        fee_percentage = self.cfg["Payments"]["CreditCard"]["fee_percentage"] / 100
-        fee_fixed = self.cfg["Payments"]["CreditCard"]["fee_fixed"]
-        total_fee = amount * fee_percentage + fee_fixed
-        if total_fee > 0:
-            return total_fee
-        
-        return 0
+        return max(0, amount * self._cc_fee_rate + self._cc_fee_fixed)
 
     def __admin_menu(self):
         
         log.debug("Displaying __admin_menu")
         
+        # Switching to user mode never comes back here, so the labels can't change while this loop runs
+        menu_products = self.loc.get("menu_products")
+        menu_orders = self.loc.get("menu_orders")
+        menu_edit_credit = self.loc.get("menu_edit_credit")
+        menu_transactions = self.loc.get("menu_transactions")
+        menu_csv = self.loc.get("menu_csv")
+        menu_edit_admins = self.loc.get("menu_edit_admins")
+        menu_user_mode = self.loc.get("menu_user_mode")
+        items = [menu_products, menu_orders, menu_user_mode, menu_edit_credit, menu_transactions, menu_csv,
+                 menu_edit_admins]
+        
         while True:
             
             keyboard = []
             if self.admin.edit_products:
-                keyboard.append([self.loc.get("menu_products")])
+                keyboard.append([menu_products])
             if self.admin.receive_orders:
-                keyboard.append([self.loc.get("menu_orders")])
+                keyboard.append([menu_orders])
             if self.admin.create_transactions:
-                keyboard.append([self.loc.get("menu_edit_credit")])
-                keyboard.append([self.loc.get("menu_transactions"), self.loc.get("menu_csv")])
+                keyboard.append([menu_edit_credit])
+                keyboard.append([menu_transactions, menu_csv])
             if self.admin.is_owner:
-                keyboard.append([self.loc.get("menu_edit_admins")])
-            keyboard.append([self.loc.get("menu_user_mode")])
+                keyboard.append([menu_edit_admins])
+            keyboard.append([menu_user_mode])
             
             self.bot.send_message(self.chat.id, self.loc.get("conversation_open_admin_menu"),
                                   reply_markup=telegram.ReplyKeyboardMarkup(keyboard, one_time_keyboard=True))
             
-            selection = self.__wait_for_specific_message([self.loc.get("menu_products"),
-                                                          self.loc.get("menu_orders"),
-                                                          self.loc.get("menu_user_mode"),
-                                                          self.loc.get("menu_edit_credit"),
-                                                          self.loc.get("menu_transactions"),
-                                                          self.loc.get("menu_csv"),
-                                                          self.loc.get("menu_edit_admins")])
+            selection = self.__wait_for_specific_message(items)
             
-            if selection == self.loc.get("menu_products"):
+            if selection == menu_products:
                 
                 self.__products_menu()
             
-            elif selection == self.loc.get("menu_orders"):
+            elif selection == menu_orders:
                 
                 self.__orders_menu()
             
-            elif selection == self.loc.get("menu_edit_credit"):
+            elif selection == menu_edit_credit:
                 
                 self.__create_transaction()
             
-            elif selection == self.loc.get("menu_user_mode"):
+            elif selection == menu_user_mode:
                 
                 self.bot.send_message(self.chat.id, self.loc.get("conversation_switch_to_user_mode"))
                 
                 self.__user_menu()
             
-            elif selection == self.loc.get("menu_edit_admins"):
+            elif selection == menu_edit_admins:
                 
                 self.__add_admin()
             
-            elif selection == self.loc.get("menu_transactions"):
+            elif selection == menu_transactions:
                 
                 self.__transaction_pages()
             
-            elif selection == self.loc.get("menu_csv"):
+            elif selection == menu_csv:
                 
                 self.__transactions_file()
 
@@ -920,13 +1121,13 @@ class Worker(threading.Thread):
         
         log.debug("Displaying __products_menu")
         
-        products = self.session.query(db.Product).filter_by(deleted=False).all()
-        
-        product_names = [product.name for product in products]
+        menu_add_product = self.loc.get("menu_add_product")
+        menu_delete_product = self.loc.get("menu_delete_product")
         
-        product_names.insert(0, self.loc.get("menu_cancel"))
-        product_names.insert(1, self.loc.get("menu_add_product"))
-        product_names.insert(2, self.loc.get("menu_delete_product"))
+        product_names = [self._t["menu_cancel"], menu_add_product, menu_delete_product]
+        product_names.extend(name for (name,) in self.session.query(db.Product)
+                             .filter_by(deleted=False)
+                             .with_entities(db.Product.name))
         
         keyboard = [[telegram.KeyboardButton(product_name)] for product_name in product_names]
         
@@ -939,11 +1140,11 @@ class Worker(threading.Thread):
             
             return
         
-        elif selection == self.loc.get("menu_add_product"):
+        elif selection == menu_add_product:
             
             self.__edit_product_menu()
         
-        elif selection == self.loc.get("menu_delete_product"):
+        elif selection == menu_delete_product:
             
             self.__delete_product_menu()
         
@@ -957,18 +1158,11 @@ class Worker(threading.Thread):
         
         log.debug("Displaying __edit_product_menu")
         
-        cancel = telegram.InlineKeyboardMarkup([[telegram.InlineKeyboardButton(self.loc.get("menu_skip"),
-                                                                               callback_data="cmd_cancel")]])
-        
         while True:
             
-            self.bot.send_message(self.chat.id, self.loc.get("ask_product_name"))
-            
-            if product:
-                self.bot.send_message(self.chat.id, self.loc.get("edit_current_value", value=escape(product.name)),
-                                      reply_markup=cancel)
+            self.__ask_product_field("ask_product_name", escape(product.name) if product else None)
             
-            name = self.__wait_for_regex(r"(.*)", cancellable=bool(product))
+            name = self.__wait_for_regex(_LINE_RE, cancellable=bool(product))
             
             if (product and isinstance(name, CancelSignal)) or \
                     self.session.query(db.Product).filter_by(name=name, deleted=False).one_or_none() in [None, product]:
@@ -976,27 +1170,15 @@ class Worker(threading.Thread):
                 break
             self.bot.send_message(self.chat.id, self.loc.get("error_duplicate_name"))
         
-        self.bot.send_message(self.chat.id, self.loc.get("ask_product_description"))
-        
-        if product:
-            self.bot.send_message(self.chat.id,
-                                  self.loc.get("edit_current_value", value=escape(product.description)),
-                                  reply_markup=cancel)
-        
-        description = self.__wait_for_regex(r"(.*)", cancellable=bool(product))
+        self.__ask_product_field("ask_product_description", escape(product.description) if product else None)
         
-        self.bot.send_message(self.chat.id,
-                              self.loc.get("ask_product_price"))
+        description = self.__wait_for_text(cancellable=bool(product))
         
-        if product:
-            self.bot.send_message(self.chat.id,
-                                  self.loc.get("edit_current_value",
-                                               value=(str(self.Price(product.price))
-                                                      if product.price is not None else 'Non in vendita')),
-                                  reply_markup=cancel)
+        self.__ask_product_field("ask_product_price",
+                                 (str(self.Price(product.price)) if product.price is not None else 'Non in vendita')
+                                 if product else None)
         
-        price = self.__wait_for_regex(r"([0-9]+(?:[.,][0-9]{1,2})?|[Xx])",
-                                      cancellable=True)
+        price = self.__wait_for_regex(_PRICE_RE, cancellable=True)
         
         if isinstance(price, CancelSignal):
             pass
@@ -1005,7 +1187,7 @@ class Worker(threading.Thread):
         else:
             price = self.Price(price)
         
-        self.bot.send_message(self.chat.id, self.loc.get("ask_product_image"), reply_markup=cancel)
+        self.bot.send_message(self.chat.id, self.loc.get("ask_product_image"), reply_markup=self._skip_inline)
         
         photo_list = self.__wait_for_photo(cancellable=True)
         
@@ -1027,10 +1209,7 @@ class Worker(threading.Thread):
         
         if isinstance(photo_list, list):
             
-            largest_photo = photo_list[0]
-            for photo in photo_list[1:]:
-                if photo.width > largest_photo.width:
-                    largest_photo = photo
+            largest_photo = max(photo_list, key=operator.attrgetter("width"))
             
             photo_file = self.bot.get_file(largest_photo.file_id)
             
@@ -1043,14 +1222,23 @@ class Worker(threading.Thread):
         
         self.bot.send_message(self.chat.id, self.loc.get("success_product_edited"))
 
+    def __ask_product_field(self, prompt: str, current_value: Optional[str]):
+        
+        # When editing, the current value goes in the same message as the question, to save a round trip
+        if current_value is None:
+            self.bot.send_message(self.chat.id, self.loc.get(prompt))
+        else:
+            self.bot.send_message(self.chat.id,
+                                  self.loc.get(prompt) + "\n\n" + self.loc.get("edit_current_value", value=current_value),
+                                  reply_markup=self._skip_inline)
+
     def __delete_product_menu(self):
         log.debug("Displaying __delete_product_menu")
         
-        products = self.session.query(db.Product).filter_by(deleted=False).all()
-        
-        product_names = [product.name for product in products]
-        
-        product_names.insert(0, self.loc.get("menu_cancel"))
+        product_names = [self._t["menu_cancel"]]
+        product_names.extend(name for (name,) in self.session.query(db.Product)
+                             .filter_by(deleted=False)
+                             .with_entities(db.Product.name))
         
         keyboard = [[telegram.KeyboardButton(product_name)] for product_name in product_names]
         
@@ -1063,9 +1251,9 @@ class Worker(threading.Thread):
             return
         else:
             
-            product = self.session.query(db.Product).filter_by(name=selection, deleted=False).one()
-            
-            product.deleted = True
+            self.session.query(db.Product) \
+                .filter_by(name=selection, deleted=False) \
+                .update({db.Product.deleted: True}, synchronize_session=False)
             self.session.commit()
             
             self.bot.send_message(self.chat.id, self.loc.get("success_product_deleted"))
@@ -1074,35 +1262,34 @@ class Worker(threading.Thread):
         
         log.debug("Displaying __orders_menu")
         
-        stop_keyboard = telegram.InlineKeyboardMarkup([[telegram.InlineKeyboardButton(self.loc.get("menu_stop"),
-                                                                                      callback_data="cmd_cancel")]])
-        cancel_keyboard = telegram.InlineKeyboardMarkup([[telegram.InlineKeyboardButton(self.loc.get("menu_cancel"),
-                                                                                        callback_data="cmd_cancel")]])
-        
         
         self.bot.send_message(self.chat.id,
                               self.loc.get("conversation_live_orders_start"),
-                              reply_markup=telegram.ReplyKeyboardRemove())
+                              reply_markup=REMOVE_KEYBOARD)
         
         self.bot.send_message(self.chat.id,
                               self.loc.get("conversation_live_orders_stop"),
-                              reply_markup=stop_keyboard)
-        
-        order_keyboard = telegram.InlineKeyboardMarkup([[telegram.InlineKeyboardButton(self.loc.get("menu_complete"),
-                                                                                       callback_data="order_complete")],
-                                                        [telegram.InlineKeyboardButton(self.loc.get("menu_refund"),
-                                                                                       callback_data="order_refund")]])
+                              reply_markup=self._stop_inline)
         
+        # Order.text needs the user, the transaction and the items of every order shown
         orders = self.session.query(db.Order) \
+            .options(sqlalchemy.orm.selectinload(db.Order.user),
+                     sqlalchemy.orm.selectinload(db.Order.transaction),
+                     sqlalchemy.orm.selectinload(db.Order.items).joinedload(db.OrderItem.product)) \
             .filter_by(delivery_date=None, refund_date=None) \
             .join(db.Transaction) \
             .join(db.User) \
             .all()
         
+        # Remember which order each message is about, so that pressing its buttons needs no lookup
+        live_orders: Dict[int, db.Order] = {}
+        
         for order in orders:
             
-            self.bot.send_message(self.chat.id, order.text(w=self, session=self.session),
-                                  reply_markup=order_keyboard)
+            message = self.bot.send_message(self.chat.id, order.text(w=self),
+                                            reply_markup=self._order_inline)
+            if message is not None:
+                live_orders[message.message_id] = order
         
         self.admin.live_mode = True
         
@@ -1116,8 +1303,13 @@ class Worker(threading.Thread):
                 self.admin.live_mode = False
                 break
             
-            order_id = re.search(self.loc.get("order_number").replace("{id}", "([0-9]+)"), update.message.text).group(1)
-            order = self.session.query(db.Order).filter(db.Order.order_id == order_id).one()
+            order = live_orders.get(update.message.message_id)
+            
+            if order is None:
+                # Orders placed during live mode are sent to admins by the customer's worker, so find them by number
+                order_id = self._order_number_re.search(update.message.text).group(1)
+                order = self.session.query(db.Order).filter(db.Order.order_id == order_id).one()
+                live_orders[update.message.message_id] = order
             
             if order.delivery_date is not None or order.refund_date is not None:
                 
@@ -1126,30 +1318,30 @@ class Worker(threading.Thread):
             
             if update.data == "order_complete":
                 
-                order.delivery_date = datetime.datetime.now()
+                order.delivery_date = sqlalchemy.func.now()
                 
                 self.session.commit()
                 
-                self.bot.edit_message_text(order.text(w=self, session=self.session), chat_id=self.chat.id,
+                self.bot.edit_message_text(order.text(w=self), chat_id=self.chat.id,
                                            message_id=update.message.message_id)
                 
                 self.bot.send_message(order.user_id,
                                       self.loc.get("notification_order_completed",
-                                                   order=order.text(w=self, session=self.session, user=True)))
+                                                   order=order.text(w=self, user=True)))
             
             elif update.data == "order_refund":
                 
                 reason_msg = self.bot.send_message(self.chat.id, self.loc.get("ask_refund_reason"),
-                                                   reply_markup=cancel_keyboard)
+                                                   reply_markup=self._cancel_inline)
                 
-                reply = self.__wait_for_regex("(.*)", cancellable=True)
+                reply = self.__wait_for_text(cancellable=True)
                 
                 if isinstance(reply, CancelSignal):
                     
                     self.bot.delete_message(self.chat.id, reason_msg.message_id)
                     continue
                 
-                order.refund_date = datetime.datetime.now()
+                order.refund_date = sqlalchemy.func.now()
                 
                 order.refund_reason = reply
                 
@@ -1159,13 +1351,12 @@ class Worker(threading.Thread):
                 
                 self.session.commit()
                 
-                self.bot.edit_message_text(order.text(w=self, session=self.session),
+                self.bot.edit_message_text(order.text(w=self),
                                            chat_id=self.chat.id,
                                            message_id=update.message.message_id)
                 
                 self.bot.send_message(order.user_id,
                                       self.loc.get("notification_order_refunded", order=order.text(w=self,
-                                                                                                   session=self.session,
                                                                                                    user=True)))
                 
                 self.bot.send_message(self.chat.id, self.loc.get("success_order_refunded", order_id=order.order_id))
@@ -1179,21 +1370,18 @@ class Worker(threading.Thread):
         if isinstance(user, CancelSignal):
             return
         
-        cancel = telegram.InlineKeyboardMarkup([[telegram.InlineKeyboardButton(self.loc.get("menu_cancel"),
-                                                                               callback_data="cmd_cancel")]])
+        self.bot.send_message(self.chat.id, self.loc.get("ask_credit"), reply_markup=self._cancel_inline)
         
-        self.bot.send_message(self.chat.id, self.loc.get("ask_credit"), reply_markup=cancel)
-        
-        reply = self.__wait_for_regex(r"(-? ?[0-9]{1,3}(?:[.,][0-9]{1,2})?)", cancellable=True)
+        reply = self.__wait_for_regex(_CREDIT_RE, cancellable=True)
         
         if isinstance(reply, CancelSignal):
             return
         
         price = self.Price(reply)
         
-        self.bot.send_message(self.chat.id, self.loc.get("ask_transaction_notes"), reply_markup=cancel)
+        self.bot.send_message(self.chat.id, self.loc.get("ask_transaction_notes"), reply_markup=self._cancel_inline)
         
-        reply = self.__wait_for_regex(r"(.*)", cancellable=True)
+        reply = self.__wait_for_text(cancellable=True)
         
         if isinstance(reply, CancelSignal):
             return
@@ -1219,16 +1407,18 @@ class Worker(threading.Thread):
         
         log.debug("Displaying __help_menu")
         
-        keyboard = [[telegram.KeyboardButton(self.loc.get("menu_contact_shopkeeper"))],
+        menu_contact_shopkeeper = self.loc.get("menu_contact_shopkeeper")
+        keyboard = [[telegram.KeyboardButton(menu_contact_shopkeeper)],
                     [telegram.KeyboardButton(self.loc.get("menu_cancel"))]]
         
         self.bot.send_message(self.chat.id,
                               self.loc.get("conversation_open_help_menu"),
                               reply_markup=telegram.ReplyKeyboardMarkup(keyboard, one_time_keyboard=True))
         
-        selection = self.__wait_for_specific_message(self.loc.get("menu_contact_shopkeeper"), cancellable=True)
+        # A set, as a bare string would accept any substring of the label
+        selection = self.__wait_for_specific_message({menu_contact_shopkeeper}, cancellable=True)
         
-        if selection == self.loc.get("menu_contact_shopkeeper"):
+        if selection == menu_contact_shopkeeper:
             
             shopkeepers = self.session.query(db.Admin).filter_by(display_on_help=True).join(db.User).all()
             
@@ -1245,35 +1435,54 @@ class Worker(threading.Thread):
         
         message = self.bot.send_message(self.chat.id, self.loc.get("loading_transactions"))
         
+        menu_previous = self.loc.get("menu_previous")
+        menu_next = self.loc.get("menu_next")
+        done_row = [telegram.InlineKeyboardButton(self._t["menu_done"], callback_data="cmd_done")]
+        
+        # Pages are fetched by seeking below the last transaction id of the page before them, instead of offsetting,
+        # and every page is rendered only once, so that going back and forth between pages is free
+        page_after: List[Optional[int]] = [None]
+        pages: Dict[int, Tuple[str, telegram.InlineKeyboardMarkup, bool]] = {}
+        
         while True:
             
-            transactions = self.session.query(db.Transaction) \
-                .order_by(db.Transaction.transaction_id.desc()) \
-                .limit(10) \
-                .offset(10 * page) \
-                .all()
-            
-            inline_keyboard_list = [[]]
-            
-            if page != 0:
+            if page not in pages:
                 
-                inline_keyboard_list[0].append(
-                    telegram.InlineKeyboardButton(self.loc.get("menu_previous"), callback_data="cmd_previous")
-                )
-            
-            if len(transactions) == 10:
+                query = self.session.query(db.Transaction) \
+                    .options(sqlalchemy.orm.selectinload(db.Transaction.user))
+                if page_after[page] is not None:
+                    query = query.filter(db.Transaction.transaction_id < page_after[page])
+                transactions = query \
+                    .order_by(db.Transaction.transaction_id.desc()) \
+                    .limit(10) \
+                    .all()
                 
-                inline_keyboard_list[0].append(
-                    telegram.InlineKeyboardButton(self.loc.get("menu_next"), callback_data="cmd_next")
-                )
-            
-            inline_keyboard_list.append(
-                [telegram.InlineKeyboardButton(self.loc.get("menu_done"), callback_data="cmd_done")])
-            
-            inline_keyboard = telegram.InlineKeyboardMarkup(inline_keyboard_list)
+                has_next = len(transactions) == 10
+                if has_next and len(page_after) == page + 1:
+                    page_after.append(transactions[-1].transaction_id)
+                
+                inline_keyboard_list = [[]]
+                
+                if page != 0:
+                    
+                    inline_keyboard_list[0].append(
+                        telegram.InlineKeyboardButton(menu_previous, callback_data="cmd_previous")
+                    )
+                
+                if has_next:
+                    
+                    inline_keyboard_list[0].append(
+                        telegram.InlineKeyboardButton(menu_next, callback_data="cmd_next")
+                    )
+                
+                inline_keyboard_list.append(done_row)
+                
+                transactions_string = "\n".join([transaction.text(w=self) for transaction in transactions])
+                pages[page] = (self.loc.get("transactions_page", page=page + 1, transactions=transactions_string),
+                               telegram.InlineKeyboardMarkup(inline_keyboard_list),
+                               has_next)
             
-            transactions_string = "\n".join([transaction.text(w=self) for transaction in transactions])
-            text = self.loc.get("transactions_page", page=page + 1, transactions=transactions_string)
+            text, inline_keyboard, has_next = pages[page]
             
             self.bot.edit_message_text(chat_id=self.chat.id, message_id=message.message_id, text=text,
                                        reply_markup=inline_keyboard)
@@ -1284,7 +1493,7 @@ class Worker(threading.Thread):
                 
                 page -= 1
             
-            elif selection.data == "cmd_next" and len(transactions) == 10:
+            elif selection.data == "cmd_next" and has_next:
                 
                 page += 1
             
@@ -1296,47 +1505,63 @@ class Worker(threading.Thread):
         
         log.debug("Generating __transaction_file")
         
-        transactions = self.session.query(db.Transaction).order_by(db.Transaction.transaction_id.asc()).all()
-        
-        try:
-            with open(f"transactions_{self.chat.id}.csv", "x"):
-                pass
-        except IOError:
-            pass
-        
-        with open(f"transactions_{self.chat.id}.csv", "w") as file:
-            
-            file.write(f"UserID;"
-                       f"TransactionValue;"
-                       f"TransactionNotes;"
-                       f"Provider;"
-                       f"ChargeID;"
-                       f"SpecifiedName;"
-                       f"SpecifiedPhone;"
-                       f"SpecifiedEmail;"
-                       f"Refunded?\n")
-            
-            for transaction in transactions:
-                file.write(f"{transaction.user_id if transaction.user_id is not None else ''};"
-                           f"{transaction.value if transaction.value is not None else ''};"
-                           f"{transaction.notes if transaction.notes is not None else ''};"
-                           f"{transaction.provider if transaction.provider is not None else ''};"
-                           f"{transaction.provider_charge_id if transaction.provider_charge_id is not None else ''};"
-                           f"{transaction.payment_name if transaction.payment_name is not None else ''};"
-                           f"{transaction.payment_phone if transaction.payment_phone is not None else ''};"
-                           f"{transaction.payment_email if transaction.payment_email is not None else ''};"
-                           f"{transaction.refunded if transaction.refunded is not None else ''}\n")
+        if self.session.query(db.Transaction.transaction_id).first() is None:
+            self.bot.send_message(self.chat.id, self.loc.get("csv_empty"))
+            return
         
-        self.bot.send_message(self.chat.id, self.loc.get("csv_caption"))
+        # Stream the table in batches instead of loading every transaction at once
+        transactions = self.session.query(db.Transaction) \
+            .order_by(db.Transaction.transaction_id.asc()) \
+            .yield_per(1000)
         
-        with open(f"transactions_{self.chat.id}.csv") as file:
-            
-            requests.post(f"https://api.telegram.org/bot{self.cfg['Telegram']['token']}/sendDocument",
-                          files={"document": file},
-                          params={"chat_id": self.chat.id,
-                                  "parse_mode": "HTML"})
+        # Every export gets its own file, as the previous worker of this chat may still be uploading one
+        fd, path = tempfile.mkstemp(prefix=f"transactions_{self.chat.id}_", suffix=".csv")
+        try:
+            with open(fd, "w", newline="") as file:
+                
+                # csv writes None as an empty field, which is what the export used for missing values
+                writer = csv.writer(file, delimiter=";", lineterminator="\n")
+                writer.writerow(["UserID",
+                                 "TransactionValue",
+                                 "TransactionNotes",
+                                 "Provider",
+                                 "ChargeID",
+                                 "SpecifiedName",
+                                 "SpecifiedPhone",
+                                 "SpecifiedEmail",
+                                 "Refunded?"])
+                writer.writerows((transaction.user_id,
+                                  transaction.value,
+                                  transaction.notes,
+                                  transaction.provider,
+                                  transaction.provider_charge_id,
+                                  transaction.payment_name,
+                                  transaction.payment_phone,
+                                  transaction.payment_email,
+                                  transaction.refunded) for transaction in transactions)
+        except Exception:
+            os.remove(path)
+            raise
+        
+        # Uploading a large export can take a while, and the admin menu doesn't need to wait for it
+        _upload_pool.submit(self.__upload_transactions_file, path)
+
+    def __upload_transactions_file(self, path: str):
         
-        os.remove(f"transactions_{self.chat.id}.csv")
+        try:
+            # Read the contents up front, so that a retried upload doesn't send a file handle already at its end
+            with open(path, "rb") as file:
+                document = file.read()
+            
+            self.bot.send_document(self.chat.id,
+                                   document=document,
+                                   filename=f"transactions_{self.chat.id}.csv",
+                                   caption=self.loc.get("csv_caption"),
+                                   parse_mode="HTML")
+        except Exception as e:
+            log.error(f"Failed to upload the transactions file of {self}: {e}")
+        finally:
+            os.remove(path)
 
     def __add_admin(self):
         
@@ -1350,15 +1575,15 @@ class Worker(threading.Thread):
         admin = self.session.query(db.Admin).filter_by(user_id=user.user_id).one_or_none()
         if admin is None:
             
-            keyboard = telegram.ReplyKeyboardMarkup([[self.loc.get("emoji_yes"), self.loc.get("emoji_no")]],
-                                                    one_time_keyboard=True)
+            choices = [self.loc.get("emoji_yes"), self.loc.get("emoji_no")]
+            keyboard = telegram.ReplyKeyboardMarkup([choices], one_time_keyboard=True)
             
             self.bot.send_message(self.chat.id, self.loc.get("conversation_confirm_admin_promotion"),
                                   reply_markup=keyboard)
             
-            selection = self.__wait_for_specific_message([self.loc.get("emoji_yes"), self.loc.get("emoji_no")])
+            selection = self.__wait_for_specific_message(choices)
             
-            if selection == self.loc.get("emoji_no"):
+            if selection == choices[1]:
                 return
             
             admin = db.Admin(user=user,
@@ -1371,30 +1596,23 @@ class Worker(threading.Thread):
         
         message = self.bot.send_message(self.chat.id, self.loc.get("admin_properties", name=str(admin.user)))
         
+        # Only the state of the toggles changes between edits, so resolve the labels once
+        emoji_yes = self.loc.boolmoji(True)
+        emoji_no = self.loc.boolmoji(False)
+        toggles = [("edit_products", self.loc.get("prop_edit_products")),
+                   ("receive_orders", self.loc.get("prop_receive_orders")),
+                   ("create_transactions", self.loc.get("prop_create_transactions")),
+                   ("display_on_help", self.loc.get("prop_display_on_help"))]
+        done_row = [telegram.InlineKeyboardButton(self._t["menu_done"], callback_data="cmd_done")]
+        
         while True:
             
-            inline_keyboard = telegram.InlineKeyboardMarkup([
-                [telegram.InlineKeyboardButton(
-                    f"{self.loc.boolmoji(admin.edit_products)} {self.loc.get('prop_edit_products')}",
-                    callback_data="toggle_edit_products"
-                )],
-                [telegram.InlineKeyboardButton(
-                    f"{self.loc.boolmoji(admin.receive_orders)} {self.loc.get('prop_receive_orders')}",
-                    callback_data="toggle_receive_orders"
-                )],
-                [telegram.InlineKeyboardButton(
-                    f"{self.loc.boolmoji(admin.create_transactions)} {self.loc.get('prop_create_transactions')}",
-                    callback_data="toggle_create_transactions"
-                )],
-                [telegram.InlineKeyboardButton(
-                    f"{self.loc.boolmoji(admin.display_on_help)} {self.loc.get('prop_display_on_help')}",
-                    callback_data="toggle_display_on_help"
-                )],
-                [telegram.InlineKeyboardButton(
-                    self.loc.get('menu_done'),
-                    callback_data="cmd_done"
-                )]
-            ])
+            inline_keyboard_list = [[telegram.InlineKeyboardButton(
+                f"{emoji_yes if getattr(admin, prop) else emoji_no} {label}",
+                callback_data=f"toggle_{prop}"
+            )] for prop, label in toggles]
+            inline_keyboard_list.append(done_row)
+            inline_keyboard = telegram.InlineKeyboardMarkup(inline_keyboard_list)
             
             self.bot.edit_message_reply_markup(message_id=message.message_id,
                                                chat_id=self.chat.id,
@@ -1417,68 +1635,97 @@ class Worker(threading.Thread):
     def __language_menu(self):
         
         log.debug("Displaying __language_menu")
-        keyboard = []
-        options: Dict[str, str] = {}
-        
-        if "it" in self.cfg["Language"]["enabled_languages"]:
-            lang = "🇮🇹 Italiano"
-            keyboard.append([telegram.KeyboardButton(lang)])
-            options[lang] = "it"
-        if "en" in self.cfg["Language"]["enabled_languages"]:
-            lang = "🇬🇧 English"
-            keyboard.append([telegram.KeyboardButton(lang)])
-            options[lang] = "en"
-        if "ru" in self.cfg["Language"]["enabled_languages"]:
-            lang = "🇷🇺 Русский"
-            keyboard.append([telegram.KeyboardButton(lang)])
-            options[lang] = "ru"
-        if "uk" in self.cfg["Language"]["enabled_languages"]:
-            lang = "🇺🇦 Українська"
-            keyboard.append([telegram.KeyboardButton(lang)])
-            options[lang] = "uk"
-        if "zh_cn" in self.cfg["Language"]["enabled_languages"]:
-            lang = "🇨🇳 简体中文"
-            keyboard.append([telegram.KeyboardButton(lang)])
-            options[lang] = "zh_cn"
-        if "he" in self.cfg["Language"]["enabled_languages"]:
-            lang = "🇮🇱 עברית"
-            keyboard.append([telegram.KeyboardButton(lang)])
-            options[lang] = "he"
-        if "es_mx" in self.cfg["Language"]["enabled_languages"]:
-            lang = "🇲🇽 Español"
-            keyboard.append([telegram.KeyboardButton(lang)])
-            options[lang] = "es_mx"
+        keyboard, options = _build_lang_menu(self._enabled_languages)
         
         self.bot.send_message(self.chat.id,
                               self.loc.get("conversation_language_select"),
-                              reply_markup=telegram.ReplyKeyboardMarkup(keyboard, one_time_keyboard=True))
-        
-        response = self.__wait_for_specific_message(list(options.keys()))
+                              reply_markup=keyboard)
         
-        self.user.language = options[response]
+        response = self.__wait_for_specific_message(frozenset(options))
         
-        self.session.commit()
+        language = options[response]
+        # Only the language changed, so write it directly instead of going through the unit of work;
+        # evaluating the update also applies it to the loaded user without marking it as modified
+        self.session.query(db.User) \
+            .filter(db.User.user_id == self.user.user_id) \
+            .update({db.User.language: language}, synchronize_session="evaluate")
         
-        self.__create_localization()
+        self.__create_localization(commit=True)
 
-    def __create_localization(self):
+    def __create_localization(self, commit: bool = False):
         
-        if self.user.language not in self.cfg["Language"]["enabled_languages"]:
-            log.debug(f"User's language '{self.user.language}' is not enabled, changing it to the default")
-            self.user.language = self.cfg["Language"]["default_language"]
+        language = sys.intern(self.user.language)
+        if language not in self._enabled_languages:
+            log.debug(f"User's language '{language}' is not enabled, changing it to the default")
+            self.user.language = language = self._default_language
+        # The single commit for both a language written by the caller and a reset to the default
+        if commit or self.session.is_modified(self.user):
             self.session.commit()
         
-        self.loc = localization.Localization(
-            language=self.user.language,
-            fallback=self.cfg["Language"]["fallback_language"],
-            replacements={
+        # Changing the language doesn't change the replacements, so only rebuild them if the user or the day did
+        replacements_key = (self.user.username, self.user.first_name, self.user.last_name, _today_str())
+        if replacements_key != self._replacements_key:
+            self._replacements = {
                 "user_string": str(self.user),
                 "user_mention": self.user.mention(),
                 "user_full_name": self.user.full_name,
                 "user_first_name": self.user.first_name,
-                "today": datetime.datetime.now().strftime("%a %d %b %Y"),
+                "today": replacements_key[3],
             }
+            self._replacements_key = replacements_key
+        loc = localization.Localization(
+            language=language,
+            fallback=self._fallback_language,
+            replacements=self._replacements
+        )
+        # Menu labels and the keyboards built from them only change with the language, so build them once here
+        self._t = {key: loc.get(key) for key in ("menu_order", "menu_order_status", "menu_add_credit",
+                                                 "menu_language", "menu_help", "menu_add_to_cart",
+                                                 "menu_remove_from_cart", "menu_cancel", "menu_done",
+                                                 "menu_skip")}
+        self._user_menu_items = [self._t["menu_order"],
+                                 self._t["menu_order_status"],
+                                 self._t["menu_add_credit"],
+                                 self._t["menu_language"],
+                                 self._t["menu_help"]]
+        self._user_menu_kb = telegram.ReplyKeyboardMarkup([[telegram.KeyboardButton(item)]
+                                                           for item in self._user_menu_items],
+                                                          one_time_keyboard=True)
+        self._add_only_kb = telegram.InlineKeyboardMarkup(
+            [[telegram.InlineKeyboardButton(self._t["menu_add_to_cart"], callback_data="cart_add")]]
+        )
+        self._add_remove_kb = telegram.InlineKeyboardMarkup(
+            [[telegram.InlineKeyboardButton(self._t["menu_add_to_cart"], callback_data="cart_add"),
+              telegram.InlineKeyboardButton(self._t["menu_remove_from_cart"], callback_data="cart_remove")]]
+        )
+        self._cart_empty_kb = telegram.InlineKeyboardMarkup(
+            [[telegram.InlineKeyboardButton(self._t["menu_cancel"], callback_data="cart_cancel")]]
+        )
+        self._cart_ready_kb = telegram.InlineKeyboardMarkup(
+            [[telegram.InlineKeyboardButton(self._t["menu_cancel"], callback_data="cart_cancel")],
+             [telegram.InlineKeyboardButton(self._t["menu_done"], callback_data="cart_done")]]
+        )
+        self._cancel_inline = telegram.InlineKeyboardMarkup(
+            [[telegram.InlineKeyboardButton(self._t["menu_cancel"], callback_data="cmd_cancel")]]
+        )
+        self._skip_inline = telegram.InlineKeyboardMarkup(
+            [[telegram.InlineKeyboardButton(self._t["menu_skip"], callback_data="cmd_cancel")]]
         )
+        self._stop_inline = telegram.InlineKeyboardMarkup(
+            [[telegram.InlineKeyboardButton(loc.get("menu_stop"), callback_data="cmd_cancel")]]
+        )
+        self._order_inline = telegram.InlineKeyboardMarkup(
+            [[telegram.InlineKeyboardButton(loc.get("menu_complete"), callback_data="order_complete")],
+             [telegram.InlineKeyboardButton(loc.get("menu_refund"), callback_data="order_refund")]]
+        )
+        # Matches the order number heading of order messages, to find out which order a button belongs to
+        self._order_number_re = re.compile("([0-9]+)".join(re.escape(part)
+                                                             for part in loc.get("order_number").split("{id}")))
+        # Without arguments, get leaves the {symbol} and {value} fields in place to be filled in by Price.__str__
+        self._currency_fmt = loc.get("currency_format_string")
+        # Set before loc, as core only reads cancel_text from workers that are ready
+        self.cancel_text = self._t["menu_cancel"]
+        self.loc = loc
 
     def __graceful_stop(self, stop_trigger: StopSignal):
         
@@ -1487,10 +1734,12 @@ class Worker(threading.Thread):
         if stop_trigger.reason == "timeout":
             
             self.bot.send_message(self.chat.id, self.loc.get('conversation_expired'),
-                                  reply_markup=telegram.ReplyKeyboardRemove())
-        
+                                  reply_markup=REMOVE_KEYBOARD)
         
+        # Anything not committed by now belongs to an interrupted action, so discard it instead of flushing it
+        try:
+            self.session.rollback()
+        finally:
+            self.session.close()
         
-        self.session.close()
-        
-        sys.exit(0)
+        raise ConversationStopped()